@@ -1,30 +1,22 @@
 #!/usr/bin/python3
 # SPDX-License-Identifier: LGPL-2.1+
 
-import argparse
-import email.header
-import mailbox
+import atexit
+import functools
 import math
 import os
 import os.path as op
-import shutil
+import shlex
 import subprocess
 import sys
-import tempfile
 
 from contextlib import contextmanager
-from time import strftime
 
 from .helpers import error, info, fatal, warn
 from .helpers import run_wrapper, set_debugging
+from . import helpers
 from . import __version__
 
-try:
-    import argcomplete
-except ImportError:
-    warn("can't find python3-argcomplete: argument completion won't be available")
-    pass
-
 
 # external commands
 git = run_wrapper('git', capture=True)
@@ -32,10 +24,75 @@ git_can_fail = run_wrapper('git', capture=True, check=False)
 
 nul_f = open(os.devnull, 'w')
 
+
+# Long running `git cat-file --batch-check` used to resolve revisions without
+# spawning a new git process for each of them. It's only started on first use
+# and if it dies (e.g. git bails out on a revision it can't parse) we fall back
+# to git-rev-parse for that revision and start a new one on the next call.
+class _GitSession:
+    def __init__(self):
+        self.proc = None
+        atexit.register(self.close)
+
+    def close(self):
+        if self.proc is None:
+            return
+
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
+
+    def _lookup(self, rev):
+        if self.proc is None:
+            cmd = ["git", "cat-file", "--batch-check=%(objectname)"]
+            if helpers.debug_run:
+                print("+ " + " ".join(shlex.quote(x) for x in cmd) + " &", file=sys.stderr)
+            self.proc = subprocess.Popen(cmd,
+                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=nul_f, universal_newlines=True)
+
+        if helpers.debug_run:
+            print("+ (cat-file) " + shlex.quote(rev), file=sys.stderr)
+
+        try:
+            self.proc.stdin.write(rev + "\n")
+            self.proc.stdin.flush()
+            return self.proc.stdout.readline()
+        except BrokenPipeError:
+            return ""
+
+    # Return the object name @rev points to or None if it doesn't exist
+    def rev_parse(self, rev):
+        out = self._lookup(rev)
+        if not out:
+            self.close()
+            ret = git_can_fail(["rev-parse", "--verify", "-q", rev], stderr=nul_f)
+            return ret.stdout.strip() if ret.returncode == 0 else None
+
+        # "<rev> missing" or "<rev> ambiguous"
+        if " " in out:
+            return None
+
+        return out.strip()
+
+
+_git_session = _GitSession()
+
+
+def rev_parse(rev):
+    return _git_session.rev_parse(rev)
+
+
 def log10_or_zero(n):
     return math.log10(n) if n else 0
 
 def assert_required_tools():
+    import shutil
+
     error_msg_git = "git >= 2.19 is needed, please check requirements"
 
     # We need git range-diff from git >= 2.19. Instead of checking the version, let's try to check
@@ -43,7 +100,7 @@ def assert_required_tools():
     # like worktree working properly. However that should be available on any version that has
     # range-diff.
     try:
-        exec_path = git("--exec-path").stdout.strip()
+        exec_path = git(["--exec-path"]).stdout.strip()
     except subprocess.CalledProcessError:
         fatal(error_msg_git)
 
@@ -52,7 +109,7 @@ def assert_required_tools():
         # Let's be resilient to weird installations not having the symlink in place.
         # For some reason "git range-diff -h" returns 129 rather than the usual 0
         # ¯\_(ツ)_/¯
-        if git("range-diff -h", check=False, capture=False, stderr=nul_f).returncode != 129:
+        if git(["range-diff", "-h"], check=False, capture=False, stderr=nul_f).returncode != 129:
             fatal(error_msg_git)
 
 class Config:
@@ -62,12 +119,12 @@ class Config:
         self.pile_branch = ""
         self.format_add_header = ""
 
-        s = git(["config", "--get-regexp", "^pile\\.*"], check=False, stderr=nul_f).stdout.strip()
-        if not s:
-            return
-
-        for kv in s.split('\n'):
-            key, value = kv.strip().split(maxsplit=1)
+        # NUL-terminated "key\nvalue" records so values may contain any char
+        s = git(["config", "-z", "--get-regexp", "^pile\\."], check=False, stderr=nul_f).stdout
+        for kv in s.split('\0'):
+            if not kv:
+                continue
+            key, _, value = kv.partition('\n')
             # pile.*
             key = key[5:].replace('-', '_')
             setattr(self, key, value)
@@ -88,27 +145,64 @@ class Config:
 
         self.dir = other.dir
         if self.dir:
-            git("config pile.dir %s" % self.dir)
+            git(["config", "pile.dir", self.dir])
 
         self.result_branch = other.result_branch
         if self.result_branch:
-            git("config pile.result-branch %s" % self.result_branch)
+            git(["config", "pile.result-branch", self.result_branch])
 
         self.pile_branch = other.pile_branch
         if self.pile_branch:
-            git("config pile.pile-branch %s" % self.pile_branch)
+            git(["config", "pile.pile-branch", self.pile_branch])
 
 
     def destroy(self):
-        git("config --remove-section pile", check=False, stderr=nul_f, stdout=nul_f)
+        git(["config", "--remove-section", "pile"], check=False, stderr=nul_f, stdout=nul_f)
+
+
+# Configuration is read once per process: use get_config.cache_clear() after
+# changing it
+@functools.lru_cache(maxsize=1)
+def get_config():
+    return Config()
+
+
+# All of git's configuration as a dict, read with a single git-config call
+# and cached: use it for the values that are only read (user.*, format.*).
+# As with git-config --get, the last value wins for multi-valued keys.
+@functools.lru_cache(maxsize=1)
+def get_git_config():
+    s = git(["config", "-z", "-l"], check=False, stderr=nul_f).stdout
+    cfg = dict()
+    for kv in s.split('\0'):
+        if not kv:
+            continue
+        key, _, value = kv.partition('\n')
+        cfg[key] = value
+
+    return cfg
+
+
+# Return (user.name, user.email) to be used in the From header of the patches
+# we generate ourselves
+def get_user_ident():
+    gitconfig = get_git_config()
+    user = gitconfig.get("user.name", "").strip()
+    email = gitconfig.get("user.email", "").strip()
+    if not user or not email:
+        fatal("user.name and user.email must be configured to generate patches.\n"
+              "Set them with 'git config user.name \"Your Name\"' and "
+              "'git config user.email you@example.com'")
+
+    return user, email
 
 
 def git_branch_exists(branch):
-    return git("show-ref --verify --quiet refs/heads/%s" % branch, check=False).returncode == 0
+    return git(["show-ref", "--verify", "--quiet", "refs/heads/" + branch], check=False).returncode == 0
 
 
 def git_remote_branch_exists(remote_and_branch):
-    return git("show-ref --verify --quiet refs/remotes/%s" % remote_and_branch, check=False).returncode == 0
+    return git(["show-ref", "--verify", "--quiet", "refs/remotes/" + remote_and_branch], check=False).returncode == 0
 
 
 # Return the toplevel directory of the outermost git root, i.e. even if you are in a worktree
@@ -124,29 +218,40 @@ def git_remote_branch_exists(remote_and_branch):
 # It works when we have a .git dir inside a work tree, but not in the rare cases of
 # having a gitdir detached from the worktree
 def git_root():
-    commondir = git("rev-parse --git-common-dir").stdout.strip("\n")
-    return git("-C %s rev-parse --show-toplevel" % op.join(commondir, "..")).stdout.strip("\n")
+    # Common case: CWD is in the main worktree and a single git call is enough
+    ret = git_can_fail(["rev-parse", "--git-common-dir", "--show-toplevel"], stderr=nul_f)
+    if ret.returncode == 0:
+        commondir, toplevel = ret.stdout.splitlines()
+        if op.realpath(op.join(commondir, "..")) == toplevel:
+            return toplevel
+    else:
+        commondir = git(["rev-parse", "--git-common-dir"]).stdout.strip("\n")
+
+    return git(["-C", op.join(commondir, ".."), "rev-parse", "--show-toplevel"]).stdout.strip("\n")
 
 
 # Return the path a certain branch is checked out at
 # or None.
 def git_worktree_get_checkout_path(root, branch):
     state = dict()
-    out = git("-C %s worktree list --porcelain" % root).stdout.split("\n")
+    out = git(["-C", root, "worktree", "list", "--porcelain"]).stdout.split("\n")
+    ref = "refs/heads/" + branch
     path = None
 
     for l in out:
         if not l:
             # end block
-            if state.get("branch", None) == "refs/heads/" + branch:
+            if state.get("branch", None) == ref:
                 path = op.realpath(state["worktree"])
                 break
 
             state = dict()
             continue
 
-        v = l.split(" ")
-        state[v[0]] = v[1] if len(v) > 1 else None
+        # only keep what we need; the path may contain spaces
+        k, _, v = l.partition(" ")
+        if k in ("branch", "worktree"):
+            state[k] = v
 
     # make sure `git worktree list` is in sync with reality
     if not path or not op.isdir(path):
@@ -158,7 +263,7 @@ def git_worktree_get_checkout_path(root, branch):
 # Get the git dir (aka .git) directory for the worktree related to
 # the @path. @path defaults to CWD
 def git_worktree_get_git_dir(path='.'):
-    return git("-C %s rev-parse --git-dir" % path).stdout.strip("\n")
+    return git(["-C", path, "rev-parse", "--git-dir"]).stdout.strip("\n")
 
 
 def _parse_baseline_line(iterable):
@@ -170,7 +275,7 @@ def _parse_baseline_line(iterable):
 
 
 def get_baseline_from_branch(branch):
-    out = git("show %s:config --" % branch).stdout
+    out = git(["show", branch + ":config", "--"]).stdout
     return _parse_baseline_line(out.splitlines())
 
 
@@ -180,9 +285,25 @@ def get_baseline(d):
 
 
 def update_baseline(d, commit):
-    with open(op.join(d, "config"), "w") as f:
-        rev = git("rev-parse %s" % commit).stdout.strip()
-        f.write("BASELINE=%s" % rev)
+    rev = rev_parse(commit)
+    if not rev:
+        fatal("invalid commit %s" % commit)
+
+    fn = op.join(d, "config")
+    content = "BASELINE=%s" % rev
+
+    # leave the file alone if the baseline didn't move
+    try:
+        with open(fn, "r") as f:
+            if f.read() == content:
+                return
+    except FileNotFoundError:
+        pass
+
+    tmp = fn + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(content)
+    os.replace(tmp, fn)
 
 
 def update_series(d, series_list):
@@ -199,7 +320,7 @@ def update_series(d, series_list):
 # If no branch was found None is returned, which means that although
 # it looks like a remote/branch pair, it is not.
 def get_branch_from_remote_branch(remote_branch):
-    out = git("remote").stdout
+    out = git(["remote"]).stdout
     for l in out.splitlines():
         if remote_branch.startswith(l):
             return remote_branch[len(l) + 1:]
@@ -208,7 +329,7 @@ def get_branch_from_remote_branch(remote_branch):
 
 def assert_valid_pile_branch(pile):
     # --full-tree is necessary so we don't need "-C gitroot"
-    out = git("ls-tree -r --name-only --full-tree %s" % pile).stdout
+    out = git(["ls-tree", "-r", "--name-only", "--full-tree", pile]).stdout
     has_config = False
     has_series = False
     non_patches = False
@@ -232,12 +353,12 @@ def assert_valid_pile_branch(pile):
 
 def assert_valid_result_branch(result_branch, baseline):
     try:
-        git("rev-parse %s" % baseline, stderr=nul_f)
+        git(["rev-parse", baseline], stderr=nul_f)
     except subprocess.CalledProcessError:
         fatal("invalid baseline commit %s" % baseline)
 
     try:
-        out = git("merge-base %s %s" % (baseline, result_branch)).stdout.strip()
+        out = git(["merge-base", baseline, result_branch]).stdout.strip()
     except subprocess.CalledProcessError:
         out = None
 
@@ -252,23 +373,27 @@ def assert_valid_result_branch(result_branch, baseline):
 # To be used in `with` context handling.
 @contextmanager
 def temporary_worktree(commit, dir, prefix="git-pile-worktree"):
+    import tempfile
+
     class Break(Exception):
       """Break out of the with statement"""
 
     try:
         with tempfile.TemporaryDirectory(dir=dir, prefix=prefix) as d:
-            git("worktree add --detach --checkout %s %s" % (d, commit),
+            git(["worktree", "add", "--detach", "--checkout", d, commit],
                 stdout=nul_f, stderr=nul_f)
             yield d
     finally:
-        git("worktree remove %s" % d)
+        git(["worktree", "remove", d])
 
 
 def cmd_init(args):
+    import tempfile
+
     assert_required_tools()
 
     try:
-        base_commit = git("rev-parse %s" % args.baseline, stderr=nul_f).stdout.strip()
+        base_commit = git(["rev-parse", args.baseline], stderr=nul_f).stdout.strip()
     except subprocess.CalledProcessError:
         fatal("invalid baseline commit %s" % args.baseline)
 
@@ -279,13 +404,14 @@ def cmd_init(args):
     if (op.exists(args.dir)):
         fatal("'%s' already exists" % args.dir)
 
-    oldconfig = Config()
+    oldconfig = get_config()
 
-    git("config pile.dir %s" % args.dir)
-    git("config pile.pile-branch %s" % args.pile_branch)
-    git("config pile.result-branch %s" % args.result_branch)
+    git(["config", "pile.dir", args.dir])
+    git(["config", "pile.pile-branch", args.pile_branch])
+    git(["config", "pile.result-branch", args.result_branch])
 
-    config = Config()
+    get_config.cache_clear()
+    config = get_config()
 
     if not git_branch_exists(config.pile_branch):
         info("Creating branch %s" % config.pile_branch)
@@ -298,18 +424,18 @@ def cmd_init(args):
         #
         # Workaround is to do that ourselves with a temporary repository
         with tempfile.TemporaryDirectory() as d:
-            git("-C %s init" % d)
+            git(["-C", d, "init"])
             update_baseline(d, base_commit)
-            git("-C %s add -A" % d)
+            git(["-C", d, "add", "-A"])
             git(["-C", d, "commit", "-m", "Initial git-pile configuration"])
 
             # Temporary repository created, now let's fetch and create our branch
-            git("fetch %s master:%s" % (d, config.pile_branch), stdout=nul_f, stderr=nul_f)
+            git(["fetch", d, "master:" + config.pile_branch], stdout=nul_f, stderr=nul_f)
 
 
     # checkout pile branch as a new worktree
     try:
-        git("worktree add --checkout %s %s" % (config.dir, config.pile_branch),
+        git(["worktree", "add", "--checkout", config.dir, config.pile_branch],
             stdout=nul_f, stderr=nul_f)
     except:
         config.revert(oldconfig)
@@ -335,7 +461,7 @@ def cmd_setup(args):
         local_pile_branch = get_branch_from_remote_branch(args.pile_branch)
         if git_branch_exists(local_pile_branch):
             # allow case that e.g. 'origin/pile' and 'pile' point to the same commit
-            if git("rev-parse %s" % args.pile_branch).stdout == git("rev-parse %s" % local_pile_branch).stdout:
+            if git(["rev-parse", args.pile_branch]).stdout == git(["rev-parse", local_pile_branch]).stdout:
                 create_pile_branch = False
             elif not args.force:
                 fatal("using '%s' for pile but branch '%s' already exists and point elsewhere" % (args.pile_branch, local_pile_branch))
@@ -348,7 +474,7 @@ def cmd_setup(args):
     # optional arg: use current branch that is checked out in git_root()
     gitroot = git_root()
     try:
-        result_branch = args.result_branch if args.result_branch else git('-C %s symbolic-ref --short -q HEAD' % gitroot).stdout.strip()
+        result_branch = args.result_branch if args.result_branch else git(['-C', gitroot, 'symbolic-ref', '--short', '-q', 'HEAD']).stdout.strip()
     except subprocess.CalledProcessError:
         fatal("no argument passed for result branch and no branch is currently checkout at '%s'" % gitroot)
 
@@ -357,7 +483,7 @@ def cmd_setup(args):
         local_result_branch = get_branch_from_remote_branch(result_branch)
         if git_branch_exists(local_result_branch):
             # allow case that e.g. 'origin/internal' and 'internal' point to the same commit
-            if git("rev-parse %s" % result_branch).stdout == git("rev-parse %s" % local_result_branch).stdout:
+            if git(["rev-parse", result_branch]).stdout == git(["rev-parse", local_result_branch]).stdout:
                 create_result_branch = False
             elif not args.force:
                 fatal("using '%s' for result but branch '%s' already exists and point elsewhere" % (result_branch, local_result_branch))
@@ -365,7 +491,7 @@ def cmd_setup(args):
         local_result_branch = result_branch
         create_result_branch = False
     else:
-        local_result_branch = git('-C %s symbolic-ref --short -q HEAD' % gitroot).stdout.strip()
+        local_result_branch = git(['-C', gitroot, 'symbolic-ref', '--short', '-q', 'HEAD']).stdout.strip()
         create_result_branch = False
 
     # content of the pile branch looks like a pile branch?
@@ -396,38 +522,38 @@ def cmd_setup(args):
         fatal("branch '%s' is already checked out at '%s'"
               % (local_result_branch, path))
 
-    force_arg = "-f" if args.force else ""
+    force_arg = ["-f"] if args.force else []
     # Yay, it looks like all sanity checks passed and we are not being
     # fuzzy-tested, try to do the useful work
     if create_pile_branch:
         info("Creating branch %s" % local_pile_branch)
-        git("branch %s -t %s %s" % (force_arg, local_pile_branch, args.pile_branch))
+        git(["branch", *force_arg, "-t", local_pile_branch, args.pile_branch])
     if create_result_branch:
         info("Creating branch %s" % local_result_branch)
         if not path:
-            git("branch %s -t %s %s" % (force_arg, local_result_branch, result_branch))
+            git(["branch", *force_arg, "-t", local_result_branch, result_branch])
         else:
-            git("-C %s reset --hard %s" % (path, result_branch), stdout=nul_f, stderr=nul_f)
+            git(["-C", path, "reset", "--hard", result_branch], stdout=nul_f, stderr=nul_f)
 
 
     if need_worktree:
         # checkout pile branch as a new worktree
         try:
-            git("-C %s worktree add --checkout %s %s" % (gitroot, args.dir, local_pile_branch),
+            git(["-C", gitroot, "worktree", "add", "--checkout", args.dir, local_pile_branch],
                 stdout=nul_f, stderr=nul_f)
         except:
             fatal("failed to checkout worktree for '%s' at %s" % (local_pile_branch, args.dir))
 
     # write down configuration
-    git("config pile.dir %s" % args.dir)
-    git("config pile.pile-branch %s" % local_pile_branch)
-    git("config pile.result-branch %s" % local_result_branch)
+    git(["config", "pile.dir", args.dir])
+    git(["config", "pile.pile-branch", local_pile_branch])
+    git(["config", "pile.result-branch", local_result_branch])
 
-    tracked_pile = git("rev-parse --abbrev-ref %s@{u}" % local_pile_branch,
+    tracked_pile = git(["rev-parse", "--abbrev-ref", local_pile_branch + "@{u}"],
                        check=False).stdout
     if tracked_pile:
         tracked_pile = " (tracking %s)" % tracked_pile.strip()
-    tracked_result = git("rev-parse --abbrev-ref %s@{u}" % local_result_branch,
+    tracked_result = git(["rev-parse", "--abbrev-ref", local_result_branch + "@{u}"],
                          check=False).stdout
     if tracked_result:
         tracked_result = " (tracking %s)" % tracked_result.strip()
@@ -444,19 +570,21 @@ def fix_duplicate_patch_names(patches):
     if len(set(patches)) == len(patches):
         return patches
 
-    # deduplicate
+    # deduplicate, using a set to look up the names already taken
     ret = []
+    taken = set()
     max_retries = len(patches) + 2
     for p in patches:
         newp = p
         retry = 2
-        while newp in ret:
+        while newp in taken:
             if retry > max_retries:
                 raise Exception("wat!?! '%s' (max_retries=%d)" % (p, max_retries))
             newp = p + "-%d" % retry
             retry += 1
 
         ret.append(newp)
+        taken.add(newp)
     return ret
 
 
@@ -489,15 +617,10 @@ def rm_patches(dest):
 
 def has_patches(dest):
     try:
-        dir = os.scandir(dest)
-        for entry in dir:
-            if entry.is_file() and entry.name.endswith(".patch"):
-                dir.close()
-                return True
+        with os.scandir(dest) as it:
+            return any(e.name.endswith(".patch") and e.is_file(follow_symlinks=False) for e in it)
     except FileNotFoundError:
-        pass
-
-    return False
+        return False
 
 
 def parse_commit_range(commit_range, pile_dir, default_end):
@@ -516,10 +639,7 @@ def parse_commit_range(commit_range, pile_dir, default_end):
         range[1] = "HEAD"
     base, result = range
     # sanity checks
-    try:
-        git("rev-parse %s" % base, stderr=nul_f, stdout=nul_f)
-        git("rev-parse %s" % result, stderr=nul_f, stdout=nul_f)
-    except (ValueError, subprocess.CalledProcessError) as e:
+    if not rev_parse(base) or not rev_parse(result):
         fatal("Invalid commit range: %s" % commit_range)
 
     return base, result
@@ -594,10 +714,13 @@ def genpatches(output, base_commit, result_commit):
     # 3) Do not number the files: numbers will change when patches are added/removed
     # 4) To avoid filename clashes due to (3), check for each patch if a file
     #    already exists and workaround it
+    import tempfile
 
     commit_range = "%s..%s" % (base_commit, result_commit)
-    commit_list = git("rev-list --reverse %s" % commit_range).stdout.strip().split('\n')
-    if not commit_list:
+    # patches are generated by a single git-format-patch below, all we need
+    # here is to know the range is not empty
+    n_commits = int(git(["rev-list", "--count", commit_range]).stdout)
+    if n_commits == 0:
         fatal("No commits in range %s" % commit_range)
 
     series = generate_series_list(commit_range, ".patch")
@@ -606,10 +729,27 @@ def genpatches(output, base_commit, result_commit):
     # to the final destination - we can use os.rename() since we are creating
     # the directory and using a subdir as staging
     with tempfile.TemporaryDirectory() as d:
-        for idx, c in enumerate(commit_list):
-            with open(op.join(d, series[idx]), "w+") as f:
-                git(["format-patch", "--no-add-header", "--no-cc", "--subject-prefix=PATCH",
-                     "--zero-commit", "--signature=", "--stdout", "-N", "-1", c], stdout=f)
+        # a single git-format-patch for the whole range: it prints the
+        # files it created in commit order, so just rename them to the
+        # names in the series. In range mode git-format-patch honors
+        # format.coverLetter and format.thread, which must not leak into the
+        # pile: -N, --no-cover-letter and --no-thread override them
+        staging = op.join(d, "staging")
+        generated = git(["format-patch", "--no-add-header", "--no-cc", "--subject-prefix=PATCH",
+                         "--zero-commit", "--signature=", "-N", "--no-cover-letter", "--no-thread",
+                         "-o", staging, commit_range]).stdout.splitlines()
+        if len(generated) != len(series):
+            # git-format-patch skips merges, but they are in the series
+            # list: there's no patch that can represent them
+            n_merges = int(git(["rev-list", "--count", "--merges", commit_range]).stdout)
+            if n_merges:
+                fatal("%s contains %d merge commit(s): a pile can only hold linear history"
+                      % (commit_range, n_merges))
+            fatal("git-format-patch generated %d patches from %s, expected %d"
+                  % (len(generated), commit_range, len(series)))
+
+        for gen, p in zip(generated, series):
+            os.rename(gen, op.join(d, p))
 
         os.makedirs(output, exist_ok=True)
         rm_patches(output)
@@ -623,11 +763,18 @@ def genpatches(output, base_commit, result_commit):
     return 0
 
 
+# Current date in RFC 2822-compliant format, as used in the patch headers
+def rfc2822_now():
+    from time import strftime
+
+    return strftime("%a, %d %b %Y %T %z")
+
+
 def gen_cover_letter(diff, output, n_patches, baseline, pile_commit, prefix, range_diff_commits, add_header):
-    user = git("config --get user.name").stdout.strip()
-    email = git("config --get user.email").stdout.strip()
-    # RFC 2822-compliant date format
-    now = strftime("%a, %d %b %Y %T %z")
+    import shutil
+
+    user, email = get_user_ident()
+    now = rfc2822_now()
 
     # 1:  34cf518f0aab ! 1:  3a4e12046539 <commit message>
     # Let only the lines with state == !, < or >
@@ -635,7 +782,8 @@ def gen_cover_letter(diff, output, n_patches, baseline, pile_commit, prefix, ran
 
     zero_fill = int(log10_or_zero(n_patches)) + 1
     cover = op.join(output, "0000-cover-letter.patch")
-    with open(cover, "w") as f:
+    # binary mode: the diff is copied as the raw bytes git produced
+    with open(cover, "wb") as f:
         f.write("""From 0000000000000000000000000000000000000000 Mon Sep 17 00:00:00 2001
 From: {user} <{email}>
 Date: {date}
@@ -654,12 +802,12 @@ range-diff:
 
 """.format(user=user, email=email, date=now, zeroes="0".zfill(zero_fill),
            n_patches=n_patches, baseline=baseline, pile_commit=pile_commit, prefix=prefix,
-           range_diff=reduced_range_diff, add_header="\n" + add_header if add_header else ""))
+           range_diff=reduced_range_diff, add_header="\n" + add_header if add_header else "").encode())
 
-        for l in diff:
-            f.write(l)
+        diff.seek(0)
+        shutil.copyfileobj(diff, f)
 
-        f.write("--\ngit-pile {version}\n\n".format(version=__version__))
+        f.write("--\ngit-pile {version}\n\n".format(version=__version__).encode())
 
     return cover
 
@@ -668,10 +816,8 @@ def gen_full_tree_patch(output, n_patches, oldbaseline, newbaseline, oldref, new
     if oldbaseline != newbaseline:
         return None
 
-    user = git("config --get user.name").stdout.strip()
-    email = git("config --get user.email").stdout.strip()
-    # RFC 2822-compliant date format
-    now = strftime("%a, %d %b %Y %T %z")
+    user, email = get_user_ident()
+    now = rfc2822_now()
 
     fn = op.join(output, "{n_patches}-full-tree-diff.patch".format(n_patches=n_patches))
     with open(fn, "w") as f:
@@ -691,7 +837,7 @@ Auto-generated diff between {oldref}..{newref}
            add_header="\n" + add_header if add_header else ""))
 
         f.flush()
-        git("diff --stat -p --no-ext-diff {oldref}..{newref}".format(oldref=oldref, newref=newref), stdout=f)
+        git(["diff", "--stat", "-p", "--no-ext-diff", "{oldref}..{newref}".format(oldref=oldref, newref=newref)], stdout=f)
         f.flush()
 
         f.write("--\ngit-pile {version}\n\n".format(version=__version__))
@@ -699,7 +845,7 @@ Auto-generated diff between {oldref}..{newref}
     return fn
 
 def cmd_genpatches(args):
-    config = Config()
+    config = get_config()
     if not config.check_is_valid():
         return 1
 
@@ -726,7 +872,7 @@ def cmd_genpatches(args):
     genpatches(output, base, result)
 
     if commit_result:
-        git("-C %s add series config *.patch" % output)
+        git(["-C", output, "add", "series", "config", "*.patch"])
         commit_cmd = ["-C", output,  "commit"]
         if args.message:
             commit_cmd += ["-m", args.message]
@@ -746,6 +892,9 @@ class PileCover:
         self.pile_commit = pile_commit
 
     def parse(fname):
+        import mailbox
+        import tempfile
+
         if fname is None:
             oldf = sys.stdin.buffer
         else:
@@ -818,6 +967,8 @@ class PileCover:
         return PileCover(m, version, baseline, pile_commit)
 
     def dump(self, f):
+        import email.header
+
         from_str = self.m.get_from() or "0000000000000000000000000000000000000000 Mon Sep 17 00:00:00 2001"
         f.write("From %s\n" % from_str)
 
@@ -846,7 +997,7 @@ class PileCover:
 
 
 def cmd_am(args):
-    config = Config()
+    config = get_config()
     if not config.check_is_valid():
         return 1
 
@@ -889,8 +1040,7 @@ Good luck! ¯\_(ツ)_/¯"""  % (config.dir, config.pile_branch))
     return 0
 
 def check_baseline_exists(baseline):
-    ret = git_can_fail("cat-file -e {baseline}".format(baseline=baseline))
-    if ret.returncode != 0:
+    if not rev_parse(baseline):
         fatal("""baseline commit '%s' not found!
 
 If the baseline tree has been force-pushed, the old baseline commits
@@ -901,7 +1051,7 @@ or permanently in the git configuration file of the local repo.""" % (baseline))
 
 
 def git_ref_is_ancestor(ancestor, ref):
-    return git_can_fail(f"merge-base --is-ancestor {ancestor} {ref}").returncode == 0
+    return git_can_fail(["merge-base", "--is-ancestor", ancestor, ref]).returncode == 0
 
 
 def check_baseline_is_ancestor(baseline, ref):
@@ -917,9 +1067,12 @@ See the help of this command for extra details""" % (baseline, ref))
 
 
 def cmd_format_patch(args):
+    import shutil
+    import tempfile
+
     assert_required_tools()
 
-    config = Config()
+    config = get_config()
     if not config.check_is_valid():
         return 1
 
@@ -941,12 +1094,12 @@ def cmd_format_patch(args):
         if git_branch_exists(args.refs[0]):
             newref = args.refs[0]
         else:
-            newref = git("symbolic-ref --short -q {ref}".format(ref=args.refs[0]), check=False).stdout.strip()
+            newref = git(["symbolic-ref", "--short", "-q", args.refs[0]], check=False).stdout.strip()
             if not newref:
                 fatal("'{ref}' does not name a branch".format(ref=args.refs[0]))
 
         # use upstream of this branch as the old ref
-        oldref = git("rev-parse --abbrev-ref {ref}@{{u}}".format(ref=args.refs[0]), stderr=nul_f, check=False).stdout.strip()
+        oldref = git(["rev-parse", "--abbrev-ref", args.refs[0] + "@{u}"], stderr=nul_f, check=False).stdout.strip()
         if not oldref:
             fatal("'{ref}' does not have an upstream. Either set with 'git branch --set-upstream-to'\nor pass old and new branches explicitly (e.g repo/internal...my-new-branch))".format(ref=args.refs[0]))
 
@@ -956,22 +1109,20 @@ def cmd_format_patch(args):
         r1 = args.refs[0].split("..")
         r2 = args.refs[1].split("..")
         if len(r1) == len(r2) and len(r1) == 2:
-            try:
-                oldbaseline = git("rev-parse {ref}".format(ref=r1[0]), stderr=nul_f).stdout.strip()
-                newbaseline = git("rev-parse {ref}".format(ref=r2[0]), stderr=nul_f).stdout.strip()
-                oldref = git("rev-parse {ref}".format(ref=r1[1]), stderr=nul_f).stdout.strip()
-                newref = git("rev-parse {ref}".format(ref=r2[1]), stderr=nul_f).stdout.strip()
-            except subprocess.CalledProcessError:
-                if not oldbaseline or not newbaseline:
-                    fatal("{ref} does not point to a valid range".format(ref=r1))
-                fatal("{ref} does not point to a valid range".format(ref=r2))
+            oldbaseline = rev_parse(r1[0])
+            oldref = rev_parse(r1[1])
+            if not oldbaseline or not oldref:
+                fatal("{ref} does not point to a valid range".format(ref=args.refs[0]))
+            newbaseline = rev_parse(r2[0])
+            newref = rev_parse(r2[1])
+            if not newbaseline or not newref:
+                fatal("{ref} does not point to a valid range".format(ref=args.refs[1]))
         else:
-            try:
-                oldref = git("rev-parse {ref}".format(ref=args.refs[0]), stderr=nul_f).stdout.strip()
-                newref = git("rev-parse {ref}".format(ref=args.refs[1]), stderr=nul_f).stdout.strip()
-            except subprocess.CalledProcessError:
-                if not oldref:
-                    fatal("{ref} does not point to a valid ref".format(ref=args.refs[0]))
+            oldref = rev_parse(args.refs[0])
+            if not oldref:
+                fatal("{ref} does not point to a valid ref".format(ref=args.refs[0]))
+            newref = rev_parse(args.refs[1])
+            if not newref:
                 fatal("{ref} does not point to a valid ref".format(ref=args.refs[1]))
             oldbaseline = get_baseline(patchesdir)
             newbaseline = oldbaseline
@@ -985,8 +1136,9 @@ def cmd_format_patch(args):
     if not git_ref_is_ancestor(f"{config.pile_branch}", f"{config.pile_branch}@{{u}}"):
         fatal(f"'{config.pile_branch}' branch contains local commits that aren't visible outside this repo")
 
-    range_diff_commits = git("range-diff --no-color --no-patch {oldbaseline}..{oldref} {newbaseline}..{newref}".format(
-            oldbaseline=oldbaseline, newbaseline=newbaseline, oldref=oldref, newref=newref)).stdout.split("\n")
+    range_diff_commits = git(["range-diff", "--no-color", "--no-patch",
+                              "{oldbaseline}..{oldref}".format(oldbaseline=oldbaseline, oldref=oldref),
+                              "{newbaseline}..{newref}".format(newbaseline=newbaseline, newref=newref)]).stdout.split("\n")
 
     # stat lines are in the form of
     # 1:  34cf518f0aab ! 1:  3a4e12046539 <commit message>
@@ -1017,60 +1169,62 @@ def cmd_format_patch(args):
     diff_filter_list = list(set(diff_filter_list))
 
     # get a simple diff of all the changes to attach to the coverletter filtered by the
-    # output of git-range-diff
-    with temporary_worktree(config.pile_branch, root) as tmpdir:
-        ret = genpatches(tmpdir, newbaseline, newref)
-        if ret != 0:
-            return 1
-
-        git("-C %s add --force -A" % tmpdir)
-        order_file = op.join(op.dirname(op.realpath(__file__)),
-                             "data", "git-cover-order.txt")
-        diff = git(["-C", tmpdir, "diff", "--cached", "-p", "--stat", '-O', order_file, "--no-ext-diff", "--",
-                    *diff_filter_list]).stdout
-        if not diff:
-            fatal("Nothing changed from %s..%s to %s..%s"
-                    % (oldbaseline, config.result_branch, newbaseline, newref))
-
-    output = args.output_directory
-    os.makedirs(output, exist_ok=True)
-    rm_patches(output)
-
-    if args.subject_prefix:
-        prefix = args.subject_prefix
-    else:
-        try:
-            prefix = git("config --get format.subjectprefix").stdout.strip()
-        except subprocess.CalledProcessError:
-            prefix = "PATCH"
-
-    ca_commits = c_commits + a_commits
-    ca_commits.sort(key=lambda x: x[2])
-    total_patches = len(ca_commits)
-    zero_fill = int(log10_or_zero(total_patches)) + 1
-    cover = gen_cover_letter(diff, output, total_patches, newbaseline,
-                             git("rev-parse {ref}".format(ref=config.pile_branch)).stdout.strip(),
-                             prefix, range_diff_commits, add_header=config.format_add_header)
+    # output of git-range-diff. It goes straight from git to a temporary file and
+    # from there to the cover letter, without being held in memory
+    with tempfile.TemporaryFile("w+b") as diff:
+        with temporary_worktree(config.pile_branch, root) as tmpdir:
+            ret = genpatches(tmpdir, newbaseline, newref)
+            if ret != 0:
+                return 1
+
+            git(["-C", tmpdir, "add", "--force", "-A"])
+            order_file = op.join(op.dirname(op.realpath(__file__)),
+                                 "data", "git-cover-order.txt")
+            git(["-C", tmpdir, "diff", "--cached", "-p", "--stat", '-O', order_file, "--no-ext-diff", "--",
+                 *diff_filter_list], stdout=diff)
+            if os.fstat(diff.fileno()).st_size == 0:
+                fatal("Nothing changed from %s..%s to %s..%s"
+                        % (oldbaseline, config.result_branch, newbaseline, newref))
+
+        output = args.output_directory
+        os.makedirs(output, exist_ok=True)
+        rm_patches(output)
+
+        if args.subject_prefix:
+            prefix = args.subject_prefix
+        else:
+            prefix = get_git_config().get("format.subjectprefix", "PATCH").strip()
+
+        ca_commits = c_commits + a_commits
+        ca_commits.sort(key=lambda x: x[2])
+        total_patches = len(ca_commits)
+        zero_fill = int(log10_or_zero(total_patches)) + 1
+        cover = gen_cover_letter(diff, output, total_patches, newbaseline,
+                                 rev_parse(config.pile_branch),
+                                 prefix, range_diff_commits, add_header=config.format_add_header)
     print(cover)
 
     with tempfile.TemporaryDirectory() as d:
-        for i, c in enumerate(ca_commits):
-            format_cmd = ["format-patch", "--subject-prefix=PATCH", "--zero-commit", "--signature="]
-            if config.format_add_header:
-                format_cmd.extend(["--add-header", config.format_add_header])
-            format_cmd.extend(["-o", d, "-N", "-1", c[1]])
+        # only the commit changes from one patch to the next
+        format_cmd = ["format-patch", "--subject-prefix=PATCH", "--zero-commit", "--signature=",
+                      "--no-cover-letter"]
+        if config.format_add_header:
+            format_cmd.extend(["--add-header", config.format_add_header])
+        format_cmd.extend(["-o", d, "-N", "-1"])
 
-            old = git(format_cmd).stdout.strip()
+        for i, c in enumerate(ca_commits):
+            old = git([*format_cmd, c[1]]).stdout.strip()
             new = op.join(output, "%04d-%s" % (i + 1, old[len(d) + 1 + 5:]))
 
             # Copy patches to the final output direcory fixing the Subject
-            # lines to conform with the patch order and prefix
-            with open(old, "r") as oldf:
-                with open(new, "w") as newf:
+            # lines to conform with the patch order and prefix. Done in binary
+            # mode so only the new Subject needs to be encoded
+            with open(old, "rb") as oldf:
+                with open(new, "wb") as newf:
                     # parse header
-                    subject_header = "Subject: [PATCH] "
+                    subject_header = b"Subject: [PATCH] "
                     for l in oldf:
-                        if l == "\n":
+                        if l == b"\n":
                             # header end, give up, don't try to parse the body
                             fatal("patch '%s' missing subject?" % old)
                         if not l.startswith(subject_header):
@@ -1080,16 +1234,16 @@ def cmd_format_patch(args):
 
                         # found the subject, re-format it
                         title = l[len(subject_header):]
-                        newf.write("Subject: [{prefix} {i}/{n_patches}] {title}".format(
+                        newf.write("Subject: [{prefix} {i}/{n_patches}] ".format(
                                    prefix=prefix, i=str(i + 1).zfill(zero_fill),
-                                   n_patches=total_patches,
-                                   title=title))
+                                   n_patches=total_patches).encode())
+                        newf.write(title)
                         break
                     else:
                         fatal("patch '%s' missing subject?" % old)
 
-                    # write all the other lines after Subject header at once
-                    newf.writelines(oldf.readlines())
+                    # stream the rest of the patch after the Subject header
+                    shutil.copyfileobj(oldf, newf)
 
             print(new)
 
@@ -1103,7 +1257,7 @@ def cmd_format_patch(args):
     return 0
 
 def cmd_genbranch(args):
-    config = Config()
+    config = get_config()
     if not config.check_is_valid():
         return 1
 
@@ -1114,9 +1268,13 @@ def cmd_genbranch(args):
     # Make sure the baseline hasn't been pruned
     check_baseline_exists(baseline);
 
-    patchlist = [op.join(patchesdir, p.strip())
-            for p in open(op.join(patchesdir, "series")).readlines()
-            if len(p.strip()) > 0 and p[0] != "#"]
+    with open(op.join(patchesdir, "series")) as f:
+        series = [l.strip() for l in f if not l.startswith("#")]
+    patchlist = [op.join(patchesdir, p) for p in series if p]
+    for p in patchlist:
+        if not op.isfile(p):
+            fatal("patch '%s' listed in series does not exist" % p)
+
     stdout = nul_f if args.quiet else sys.stdout
     if not args.dirty:
         apply_cmd = ["am", "--no-3way"]
@@ -1138,9 +1296,9 @@ def cmd_genbranch(args):
         if not args.branch:
             # use whatever is currently checked out, might as well be in
             # detached state
-            git("reset --hard %s" % baseline)
+            git(["reset", "--hard", baseline])
         else:
-            git("checkout -B %s %s" % (args.branch, baseline))
+            git(["checkout", "-B", args.branch, baseline])
 
         ret = git_can_fail(apply_cmd + patchlist, stdout=stdout)
         if ret.returncode != 0:
@@ -1154,7 +1312,27 @@ pile patches.""")
     # work in a separate directory to avoid cluttering whatever the user is doing
     # on the main one
     with temporary_worktree(baseline, root) as d:
-        git(["-C", d] + apply_cmd + patchlist, stdout=stdout)
+        # all patches are applied by a single git-am, which stops at the
+        # first failure. If it got to apply any, rebase-apply/next has the
+        # (1-based) index of the one it stopped at; if it failed before that,
+        # e.g. splitting the patches, there's no rebase-apply dir
+        if git_can_fail(["-C", d] + apply_cmd + patchlist, stdout=stdout).returncode != 0:
+            if args.dirty:
+                fatal("failed to apply patches from '%s'" % config.dir)
+
+            rebase_apply = op.join(d, git_worktree_get_git_dir(d), "rebase-apply")
+            failed = 0
+            try:
+                with open(op.join(rebase_apply, "next")) as f:
+                    failed = int(f.read())
+            except (FileNotFoundError, ValueError):
+                pass
+
+            git_can_fail(["-C", d, "am", "--abort"], stdout=nul_f, stderr=nul_f)
+            if 0 < failed <= len(patchlist):
+                fatal("failed to apply patch %s (%d/%d)"
+                      % (patchlist[failed - 1], failed, len(patchlist)))
+            fatal("failed to apply patches from '%s'" % config.dir)
 
         if args.dirty:
             raise temporary_worktree.Break
@@ -1169,15 +1347,15 @@ pile patches.""")
                       "because it is checked out at '%s'" % (head, branch, path))
                 return 1
             else:
-                git("-C %s reset --hard %s" % (path, head), stdout=nul_f, stderr=nul_f)
+                git(["-C", path, "reset", "--hard", head], stdout=nul_f, stderr=nul_f)
         else:
-            git("-C %s checkout -f -B %s %s" % (d, branch, head), stdout=nul_f, stderr=nul_f)
+            git(["-C", d, "checkout", "-f", "-B", branch, head], stdout=nul_f, stderr=nul_f)
 
     return 0
 
 
 def cmd_baseline(args):
-    config = Config()
+    config = get_config()
     if not config.check_is_valid():
         return 1
 
@@ -1196,30 +1374,30 @@ def cmd_baseline(args):
 
 
 def cmd_destroy(args):
-    config = Config()
+    config = get_config()
 
     # everything here is relative to root
     os.chdir(git_root())
 
     # implode - we have the cached values saved in config
-    if git("config --remove-section pile", check=False, stderr=nul_f).returncode != 0:
+    if git(["config", "--remove-section", "pile"], check=False, stderr=nul_f).returncode != 0:
         fatal("pile not initialized")
 
     git_ = run_wrapper('git', capture=True, check=False, print_error_as_ignored=True)
     rm_ = run_wrapper('rm', capture=True, check=False, print_error_as_ignored=True)
 
     if config.dir and op.exists(config.dir):
-        git_("worktree remove --force {d}".format(d=config.dir))
-        rm_("-rf {d}".format(d=config.dir))
+        git_(["worktree", "remove", "--force", config.dir])
+        rm_(["-rf", config.dir])
 
-    git_("worktree prune")
+    git_(["worktree", "prune"])
 
     if config.pile_branch:
-        git_("branch -D {d}".format(d=config.pile_branch))
+        git_(["branch", "-D", config.pile_branch])
 
 
 def cmd_reset(args):
-    config = Config()
+    config = get_config()
 
     # everything here is relative to root
     gitroot = git_root()
@@ -1230,7 +1408,7 @@ def cmd_reset(args):
         fatal("Could not find checkout of %s branch, refusing to reset.\nYou should probably inspect '%s')"
               % (config.pile_branch, config.dir))
 
-    remote_pile = git_can_fail("rev-parse --abbrev-ref %s@{u}" % config.pile_branch).stdout.strip()
+    remote_pile = git_can_fail(["rev-parse", "--abbrev-ref", config.pile_branch + "@{u}"]).stdout.strip()
     if not remote_pile:
         fatal("Branch %s doesn't have an upstream" % config.pile_branch)
 
@@ -1241,9 +1419,9 @@ def cmd_reset(args):
                   "You are probably in the wrong directory for in-place reset."
                   % (config.pile_branch, config.result_branch))
 
-        local_branch = git("rev-parse --abbrev-ref HEAD").stdout.strip()
+        local_branch = git(["rev-parse", "--abbrev-ref", "HEAD"]).stdout.strip()
         if local_branch == "HEAD":
-            local_branch = git("rev-parse --short HEAD").stdout.strip() + " (detached)"
+            local_branch = git(["rev-parse", "--short", "HEAD"]).stdout.strip() + " (detached)"
     else:
         branch_dir = git_worktree_get_checkout_path(gitroot, config.result_branch)
         if not branch_dir:
@@ -1251,7 +1429,7 @@ def cmd_reset(args):
                   % (config.result_branch, gitroot))
         local_branch = config.result_branch
 
-    remote_branch = git_can_fail("rev-parse --abbrev-ref %s@{u}" % config.result_branch).stdout.strip()
+    remote_branch = git_can_fail(["rev-parse", "--abbrev-ref", config.result_branch + "@{u}"]).stdout.strip()
     if not remote_branch:
         fatal("Branch %s doesn't have an upstream" % config.result_branch)
 
@@ -1266,7 +1444,21 @@ def cmd_reset(args):
     print("Branches synchronized with their current remotes")
 
 
+# Return the subcommand in @cmd_args if it's one of @names, or None. Only
+# the first non-option argument is considered since the top-level parser
+# doesn't have options taking values
+def _sniff_subcommand(cmd_args, names):
+    for a in cmd_args:
+        if a.startswith("-"):
+            continue
+        return a if a in names else None
+
+    return None
+
+
 def parse_args(cmd_args):
+    import argparse
+
     desc = """Manage a pile of patches on top of a git branch
 
 git-pile helps to manage a long running and always changing list of patches on
@@ -1332,154 +1524,154 @@ series  config  X'.patch  Y'.patch  Z'.patch
 
     subparsers = parser.add_subparsers(title="Commands", dest="command")
 
-    # init
-    parser_init = subparsers.add_parser('init', help="Initialize configuration of an empty pile in this repository")
-    parser_init.add_argument(
-        "-d", "--dir",
-        help="Directory in which to place patches (default: %(default)s)",
-        metavar="DIR",
-        default="patches")
-    parser_init.add_argument(
-        "-p", "--pile-branch",
-        help="Branch name to use for patches (default: %(default)s)",
-        metavar="PILE_BRANCH",
-        default="pile")
-    parser_init.add_argument(
-        "-b", "--baseline",
-        help="Baseline commit on top of which the patches from PILE_BRANCH should be applied (default: %(default)s)",
-        metavar="BASELINE",
-        default="master")
-    parser_init.add_argument(
-        "-r", "--result-branch",
-        help="Branch to be created when applying patches from PILE_BRANCH on top of BASELINE (default: %(default)s)",
-        metavar="RESULT_BRANCH",
-        default="internal")
-    parser_init.set_defaults(func=cmd_init)
-
-    # setup
-    parser_setup = subparsers.add_parser('setup', help="Setup/copy configuration from a remote or already created branches")
-    parser_setup.add_argument(
-        "-d", "--dir",
-        help="Directory in which to place patches - same argument as for git-pile init (default: %(default)s)",
-        metavar="DIR",
-        default="patches")
-    parser_setup.add_argument(
-        "-f", "--force",
-        help="Always create RESULT_BRANCH, even if it's checked out in any path",
-        action="store_true",
-        default=False)
-    parser_setup.add_argument("pile_branch",
-        help="Remote or local branch used to store the physical patch files. "
-             "In case a remote branch is passed, a local one will be created "
-             "with the same name as in remote and its upstream configuration "
-             "will be set accordingly (as in 'git branch <local-name> --set-upstream-to=<pile-branch>'. "
-             "Examples: 'origin/pile', 'myfork/pile', 'internal-remote/internal-branch'. "
-             "An existent local branch may be used as long as it looks like a "
-             "pile branch. Examples: 'pile', 'patches', etc.", metavar="PILE_BRANCH")
-    parser_setup.add_argument("result_branch",
-        help="Remote or local branch that will be generated as a result of applying "
-             "the patches from PILE_BRANCH to the base commit (baseline). In "
-             "case a remote branch is passed, a local one will be created "
-             "with the same name as in remote and its upstream configuration "
-             "will be set accordingly (as in 'git branch <local-name> --set-upstream-to=<pile-branch>. "
-             "Examples: 'origin/internal', 'myfork/wip', 'rt/linux-4.18.y-rt-rebase'. "
-             "An existent local branch may be used as long as it looks like a "
-             "result branch, i.e. it must contain the baseline commit configured in PILE_BRANCH. "
-             "If this argument is omitted, the current checked out branch is used in the same way local "
-             "branches are handled.", metavar="RESULT_BRANCH", nargs="?")
-    parser_setup.set_defaults(func=cmd_setup)
-
-    # genpatches
-    parser_genpatches = subparsers.add_parser('genpatches', help="Generate patches from BASELINE..RESULT_BRANCH and save to output directory")
-    parser_genpatches.add_argument(
-        "-o", "--output-directory",
-        help="Use OUTPUT_DIR to store the resulting files instead of the DIR from the configuration. This must be an empty/non-existent directory unless -f/--force is also used",
-        metavar="OUTPUT_DIR",
-        default="")
-    parser_genpatches.add_argument(
-        "-f", "--force",
-        help="Force use of OUTPUT_DIR even if it has patches. The existent patches will be removed.",
-        action="store_true",
-        default=False)
-    parser_genpatches.add_argument(
-        "-c", "--commit-result",
-        help="Commit the generated patches to the pile on success. This is only "
-             "valid without a -o option",
-        action="store_true",
-        default=False)
-    parser_genpatches.add_argument(
-        "-m", "--message",
-        help="Use the given MSG as the commit message. This implies the "
-             "--commit-result option",
-        metavar="MSG")
-    parser_genpatches.add_argument(
-        "commit_range",
-        help="Commit range to use for the generated patches (default: BASELINE..RESULT_BRANCH)",
-        metavar="COMMIT_RANGE",
-        nargs="?",
-        default="")
-    parser_genpatches.set_defaults(func=cmd_genpatches)
-
-    # genbranch
-    parser_genbranch = subparsers.add_parser('genbranch', help="Generate RESULT_BRANCH by applying patches from PILE_BRANCH on top of BASELINE")
-    parser_genbranch.add_argument(
-        "-b", "--branch",
-        help="Use BRANCH to store the final result instead of RESULT_BRANCH",
-        metavar="BRANCH",
-        default="")
-    parser_genbranch.add_argument(
-        "-f", "--force",
-        help="Always create RESULT_BRANCH, even if it's checked out in any path",
-        action="store_true",
-        default=False)
-    parser_genbranch.add_argument(
-        "-q", "--quiet",
-        help="Quiet mode - do not print list of patches",
-        action="store_true",
-        default=False)
-    parser_genbranch.add_argument(
-        "-i", "--inplace", "--in-place",
-        help="Generate branch in-place, enable conflict resolution and recovery: the current branch in the CWD is reset to the baseline commit and patches applied",
-        action="store_true",
-        dest="inplace",
-        default=False)
-    parser_genbranch.set_defaults(func=cmd_genbranch)
-    parser_genbranch.add_argument(
-        "--dirty",
-        help="Just apply the patches, do not create the corresponding commits",
-        action="store_true",
-        dest="dirty",
-        default=False)
-
-    # format-patch
-    parser_format_patch = subparsers.add_parser('format-patch', help="Generate patches from BASELINE..HEAD and save patch series to output directory to be shared on a mailing list",
-        formatter_class=argparse.RawTextHelpFormatter)
-    parser_format_patch.add_argument(
-        "-o", "--output-directory",
-        help="Use OUTPUT_DIR to store the resulting files instead of the CWD. This must be an\n"
-             "empty/non-existent directory unless -f/--force is also used",
-        metavar="OUTPUT_DIR",
-        default=".")
-    parser_format_patch.add_argument(
-        "-f", "--force",
-        help="Force use of OUTPUT_DIR even if it has patches. The existent patches will be\n"
-             "removed.",
-        action="store_true",
-        default=False)
-    parser_format_patch.add_argument(
-        "--subject-prefix",
-        help="Instead of the standard [PATCH] prefix in the subject line, use\n"
-             "[<Subject-Prefix>]. See git-format-patch(1) for details.",
-        metavar="SUBJECT_PREFIX",
-        default=None)
-    parser_format_patch.add_argument(
-        "--no-full-patch",
-        help="Do not generate patch with full diff\n",
-        action="store_true",
-        default=False)
-    parser_format_patch.add_argument(
-        "refs",
-        help="""
+    def add_parser_init():
+        parser_init = subparsers.add_parser('init', help="Initialize configuration of an empty pile in this repository")
+        parser_init.add_argument(
+            "-d", "--dir",
+            help="Directory in which to place patches (default: %(default)s)",
+            metavar="DIR",
+            default="patches")
+        parser_init.add_argument(
+            "-p", "--pile-branch",
+            help="Branch name to use for patches (default: %(default)s)",
+            metavar="PILE_BRANCH",
+            default="pile")
+        parser_init.add_argument(
+            "-b", "--baseline",
+            help="Baseline commit on top of which the patches from PILE_BRANCH should be applied (default: %(default)s)",
+            metavar="BASELINE",
+            default="master")
+        parser_init.add_argument(
+            "-r", "--result-branch",
+            help="Branch to be created when applying patches from PILE_BRANCH on top of BASELINE (default: %(default)s)",
+            metavar="RESULT_BRANCH",
+            default="internal")
+        parser_init.set_defaults(func=cmd_init)
+
+    def add_parser_setup():
+        parser_setup = subparsers.add_parser('setup', help="Setup/copy configuration from a remote or already created branches")
+        parser_setup.add_argument(
+            "-d", "--dir",
+            help="Directory in which to place patches - same argument as for git-pile init (default: %(default)s)",
+            metavar="DIR",
+            default="patches")
+        parser_setup.add_argument(
+            "-f", "--force",
+            help="Always create RESULT_BRANCH, even if it's checked out in any path",
+            action="store_true",
+            default=False)
+        parser_setup.add_argument("pile_branch",
+            help="Remote or local branch used to store the physical patch files. "
+                 "In case a remote branch is passed, a local one will be created "
+                 "with the same name as in remote and its upstream configuration "
+                 "will be set accordingly (as in 'git branch <local-name> --set-upstream-to=<pile-branch>'. "
+                 "Examples: 'origin/pile', 'myfork/pile', 'internal-remote/internal-branch'. "
+                 "An existent local branch may be used as long as it looks like a "
+                 "pile branch. Examples: 'pile', 'patches', etc.", metavar="PILE_BRANCH")
+        parser_setup.add_argument("result_branch",
+            help="Remote or local branch that will be generated as a result of applying "
+                 "the patches from PILE_BRANCH to the base commit (baseline). In "
+                 "case a remote branch is passed, a local one will be created "
+                 "with the same name as in remote and its upstream configuration "
+                 "will be set accordingly (as in 'git branch <local-name> --set-upstream-to=<pile-branch>. "
+                 "Examples: 'origin/internal', 'myfork/wip', 'rt/linux-4.18.y-rt-rebase'. "
+                 "An existent local branch may be used as long as it looks like a "
+                 "result branch, i.e. it must contain the baseline commit configured in PILE_BRANCH. "
+                 "If this argument is omitted, the current checked out branch is used in the same way local "
+                 "branches are handled.", metavar="RESULT_BRANCH", nargs="?")
+        parser_setup.set_defaults(func=cmd_setup)
+
+    def add_parser_genpatches():
+        parser_genpatches = subparsers.add_parser('genpatches', help="Generate patches from BASELINE..RESULT_BRANCH and save to output directory")
+        parser_genpatches.add_argument(
+            "-o", "--output-directory",
+            help="Use OUTPUT_DIR to store the resulting files instead of the DIR from the configuration. This must be an empty/non-existent directory unless -f/--force is also used",
+            metavar="OUTPUT_DIR",
+            default="")
+        parser_genpatches.add_argument(
+            "-f", "--force",
+            help="Force use of OUTPUT_DIR even if it has patches. The existent patches will be removed.",
+            action="store_true",
+            default=False)
+        parser_genpatches.add_argument(
+            "-c", "--commit-result",
+            help="Commit the generated patches to the pile on success. This is only "
+                 "valid without a -o option",
+            action="store_true",
+            default=False)
+        parser_genpatches.add_argument(
+            "-m", "--message",
+            help="Use the given MSG as the commit message. This implies the "
+                 "--commit-result option",
+            metavar="MSG")
+        parser_genpatches.add_argument(
+            "commit_range",
+            help="Commit range to use for the generated patches (default: BASELINE..RESULT_BRANCH)",
+            metavar="COMMIT_RANGE",
+            nargs="?",
+            default="")
+        parser_genpatches.set_defaults(func=cmd_genpatches)
+
+    def add_parser_genbranch():
+        parser_genbranch = subparsers.add_parser('genbranch', help="Generate RESULT_BRANCH by applying patches from PILE_BRANCH on top of BASELINE")
+        parser_genbranch.add_argument(
+            "-b", "--branch",
+            help="Use BRANCH to store the final result instead of RESULT_BRANCH",
+            metavar="BRANCH",
+            default="")
+        parser_genbranch.add_argument(
+            "-f", "--force",
+            help="Always create RESULT_BRANCH, even if it's checked out in any path",
+            action="store_true",
+            default=False)
+        parser_genbranch.add_argument(
+            "-q", "--quiet",
+            help="Quiet mode - do not print list of patches",
+            action="store_true",
+            default=False)
+        parser_genbranch.add_argument(
+            "-i", "--inplace", "--in-place",
+            help="Generate branch in-place, enable conflict resolution and recovery: the current branch in the CWD is reset to the baseline commit and patches applied",
+            action="store_true",
+            dest="inplace",
+            default=False)
+        parser_genbranch.set_defaults(func=cmd_genbranch)
+        parser_genbranch.add_argument(
+            "--dirty",
+            help="Just apply the patches, do not create the corresponding commits",
+            action="store_true",
+            dest="dirty",
+            default=False)
+
+    def add_parser_format_patch():
+        parser_format_patch = subparsers.add_parser('format-patch', help="Generate patches from BASELINE..HEAD and save patch series to output directory to be shared on a mailing list",
+            formatter_class=argparse.RawTextHelpFormatter)
+        parser_format_patch.add_argument(
+            "-o", "--output-directory",
+            help="Use OUTPUT_DIR to store the resulting files instead of the CWD. This must be an\n"
+                 "empty/non-existent directory unless -f/--force is also used",
+            metavar="OUTPUT_DIR",
+            default=".")
+        parser_format_patch.add_argument(
+            "-f", "--force",
+            help="Force use of OUTPUT_DIR even if it has patches. The existent patches will be\n"
+                 "removed.",
+            action="store_true",
+            default=False)
+        parser_format_patch.add_argument(
+            "--subject-prefix",
+            help="Instead of the standard [PATCH] prefix in the subject line, use\n"
+                 "[<Subject-Prefix>]. See git-format-patch(1) for details.",
+            metavar="SUBJECT_PREFIX",
+            default=None)
+        parser_format_patch.add_argument(
+            "--no-full-patch",
+            help="Do not generate patch with full diff\n",
+            action="store_true",
+            default=False)
+        parser_format_patch.add_argument(
+            "refs",
+            help="""
 Same arguments as the ones received by range-diff in its several forms plus a
 shortcut. From more verbose to the easiest ones:
 1) OLD_BASELINE..OLD_RESULT_HEAD NEW_BASELINE..NEW_RESULT_HEAD
@@ -1497,56 +1689,77 @@ shortcut. From more verbose to the easiest ones:
     This is a shortcut: the current branch will be used as NEW_RESULT_HEAD and
     the upstream of this branch as OLD_RESULT_HEAD. Example: if RESULT_BRANCH
     is internal, this is equivalent to: internal@{u}...internal""",
-        metavar="REFS",
-        nargs="*",
-        default=["HEAD"])
-    parser_format_patch.set_defaults(func=cmd_format_patch)
-
-    # am
-    parser_am = subparsers.add_parser('am', help="Apply patch, generated by git-pile format-patch, to the series and recreate RESULT_BRANCH")
-    parser_am.add_argument(
-        "-g", "--genbranch",
-        help="When patch is correctly applied, also force-generate the "
-        "RESULT_BRANCH - this is the equivalent of calling "
-        "\"git pile genbranch -f\" after the command returns.",
-        action="store_true",
-        default=False)
-    parser_am.add_argument(
-        "mbox_cover",
-        help="Mbox/patch file containing the coverletter generated by git-pile. "
-        "If more than one patch is contained in the mbox, the first one is "
-        "assumed to be the cover. "
-        "If no arguments are passed, the mbox is read from stdin",
-        nargs="?")
-    parser_am.add_argument(
-        "-s", "--strategy",
-        help="Select the strategy used to apply the patch. \"top\", the default, "
-             "tries to apply the patch on top of PILE_BRANCH. \"pile-commit\" "
-             "first reset the pile branch to the commit saved in the cover "
-             "letter before proceeding - this allows to replicate the "
-             "exact same tree as the one that generated the cover. However "
-             "the PILE_BRANCH will have diverged.",
-        choices=["top", "pile-commit"],
-        default="top")
-    parser_am.set_defaults(func=cmd_am)
-
-    # baseline
-    parser_baseline = subparsers.add_parser('baseline', help="Return the baseline commit hash")
-    parser_baseline.set_defaults(func=cmd_baseline)
-
-    # destroy
-    parser_destroy = subparsers.add_parser('destroy', help="Destroy all git-pile on this repo")
-    parser_destroy.set_defaults(func=cmd_destroy)
-
-    # reset
-    parser_reset = subparsers.add_parser('reset', help="Reset RESULT_BRANCH and PILE_BRANCH to match remote")
-    parser_reset.add_argument(
-        "-i", "--inplace", "--in-place",
-        help="Reset branch in-place: the current branch in the CWD is reset to the upstream of RESULT_BRANCH",
-        action="store_true",
-        dest="inplace",
-        default=False)
-    parser_reset.set_defaults(func=cmd_reset)
+            metavar="REFS",
+            nargs="*",
+            default=["HEAD"])
+        parser_format_patch.set_defaults(func=cmd_format_patch)
+
+    def add_parser_am():
+        parser_am = subparsers.add_parser('am', help="Apply patch, generated by git-pile format-patch, to the series and recreate RESULT_BRANCH")
+        parser_am.add_argument(
+            "-g", "--genbranch",
+            help="When patch is correctly applied, also force-generate the "
+            "RESULT_BRANCH - this is the equivalent of calling "
+            "\"git pile genbranch -f\" after the command returns.",
+            action="store_true",
+            default=False)
+        parser_am.add_argument(
+            "mbox_cover",
+            help="Mbox/patch file containing the coverletter generated by git-pile. "
+            "If more than one patch is contained in the mbox, the first one is "
+            "assumed to be the cover. "
+            "If no arguments are passed, the mbox is read from stdin",
+            nargs="?")
+        parser_am.add_argument(
+            "-s", "--strategy",
+            help="Select the strategy used to apply the patch. \"top\", the default, "
+                 "tries to apply the patch on top of PILE_BRANCH. \"pile-commit\" "
+                 "first reset the pile branch to the commit saved in the cover "
+                 "letter before proceeding - this allows to replicate the "
+                 "exact same tree as the one that generated the cover. However "
+                 "the PILE_BRANCH will have diverged.",
+            choices=["top", "pile-commit"],
+            default="top")
+        parser_am.set_defaults(func=cmd_am)
+
+    def add_parser_baseline():
+        parser_baseline = subparsers.add_parser('baseline', help="Return the baseline commit hash")
+        parser_baseline.set_defaults(func=cmd_baseline)
+
+    def add_parser_destroy():
+        parser_destroy = subparsers.add_parser('destroy', help="Destroy all git-pile on this repo")
+        parser_destroy.set_defaults(func=cmd_destroy)
+
+    def add_parser_reset():
+        parser_reset = subparsers.add_parser('reset', help="Reset RESULT_BRANCH and PILE_BRANCH to match remote")
+        parser_reset.add_argument(
+            "-i", "--inplace", "--in-place",
+            help="Reset branch in-place: the current branch in the CWD is reset to the upstream of RESULT_BRANCH",
+            action="store_true",
+            dest="inplace",
+            default=False)
+        parser_reset.set_defaults(func=cmd_reset)
+
+    add_parser_funcs = {
+        "init": add_parser_init,
+        "setup": add_parser_setup,
+        "genpatches": add_parser_genpatches,
+        "genbranch": add_parser_genbranch,
+        "format-patch": add_parser_format_patch,
+        "am": add_parser_am,
+        "baseline": add_parser_baseline,
+        "destroy": add_parser_destroy,
+        "reset": add_parser_reset,
+    }
+
+    # building all the subparsers is only needed for the top-level help
+    # and completion: when a command is given, build just that one
+    cmd = _sniff_subcommand(cmd_args, add_parser_funcs)
+    if cmd:
+        add_parser_funcs[cmd]()
+    else:
+        for add_parser_func in add_parser_funcs.values():
+            add_parser_func()
 
     # add options to all subparsers
     for _, subp in subparsers.choices.items():
@@ -1559,9 +1772,10 @@ shortcut. From more verbose to the easiest ones:
     parser.add_argument('-v', '--version', action='version', version='git-pile ' + __version__)
 
     try:
+        import argcomplete
         argcomplete.autocomplete(parser)
-    except NameError:
-        pass
+    except ImportError:
+        warn("can't find python3-argcomplete: argument completion won't be available")
 
     args = parser.parse_args(cmd_args)
     if not hasattr(args, "func"):
@@ -26,6 +26,8 @@ class run_wrapper:
             val = cmd
 
         self.cmd = val
+        # resolved to a full path on first call, so PATH is searched only once
+        self.executable = None
         self.capture = capture
         self.check = check
         self.print_error_as_ignored = print_error_as_ignored
@@ -48,17 +50,24 @@ class run_wrapper:
 
         kwargs["check"] = kwargs.get("check", self.check)
 
+        # argv lists are passed through as is: only plain strings need to be
+        # split, and don't modify the caller's list
         if isinstance(s, str):
-            l = s.split()
+            l = [self.cmd, *s.split()]
         else:
-            l = s
-
-        l.insert(0, self.cmd)
+            l = [self.cmd, *s]
 
         cmd_debug = ' '.join(shlex.quote(x) for x in l)
         if debug_run:
             print('+ ' + cmd_debug, file=sys.stderr)
 
+        if self.executable is None:
+            import shutil
+            # absolute, so a relative PATH entry keeps working after a chdir
+            exe = shutil.which(self.cmd)
+            self.executable = os.path.abspath(exe) if exe else self.cmd
+        kwargs.setdefault("executable", self.executable)
+
         ret = subprocess.run(l, *args, **kwargs)
 
         if self.print_error_as_ignored and ret.returncode != 0: